@@ -29,12 +29,17 @@ from . import ui, properties, operators
 classes = (
     properties.AddonPreferences,
     properties.SanitizeRigifyBoneProperty,
+    properties.SanitizeRigifyTrackProperty,
+    properties.SanitizeRigifyDatablockProperty,
     properties.SanitizeRigifyProperties,
     operators.SANITIZERIGIFY_OT_Preview,
     operators.SANITIZERIGIFY_OT_Unpreview,
     operators.SANITIZERIGIFY_OT_Export,
+    operators.SANITIZERIGIFY_OT_Validate,
+    operators.SANITIZERIGIFY_OT_CheckGeneratedData,
     operators.SANITIZERIGIFY_OT_ResetArmatureName,
     operators.SANITIZERIGIFY_OT_AddAdditionalBone,
+    operators.SANITIZERIGIFY_OT_AddAdditionalBones,
     operators.SANITIZERIGIFY_OT_RemoveAdditionalBone,
     operators.SANITIZERIGIFY_OT_ClearAdditionalBones,
     ui.SANITIZERIGIFY_UL_UIList,
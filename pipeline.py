@@ -0,0 +1,1185 @@
+import bpy
+from mathutils import Matrix
+from . import properties
+import logging
+import traceback
+from cmath import inf
+import os
+import hashlib
+import array
+import json
+import tempfile
+import numpy as np
+
+def deselect_all(context):
+    """deselect all and set to object mode. Returns tuple of current mode, current active object and current selected objects"""
+    current_selected = context.selected_objects
+    current_active = None
+    if current_selected is not None:
+        current_active = context.view_layer.objects.active
+    current_mode = None
+    if current_active:
+        current_mode = current_active.mode
+    if current_mode and current_mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+
+    bpy.ops.object.select_all(action='DESELECT')
+    context.view_layer.objects.active = None
+
+    return current_active, current_selected, current_mode
+
+def restore_selection(context, active, selected, mode):
+    deselect_all(context)
+    if selected is None or len(selected) < 1:
+        return
+    try:
+        for obj in bpy.data.objects:
+            obj.select_set(obj in selected)
+        context.view_layer.objects.active = active
+        bpy.ops.object.mode_set(mode=mode, toggle=False)
+    except Exception as e:
+        logging.info(traceback.format_exc())
+
+def add_scene_objects_to_collection(context, scene_objects, collection_name):
+    """move scene_objects into the collection_name collection (created if needed), resolving the collection once"""
+    scene_objects = [scene_object for scene_object in scene_objects if scene_object]
+    if not scene_objects:
+        return
+    # create collection if it does not exist
+    collection = bpy.data.collections.get(collection_name)
+    if collection is None:
+        collection = bpy.data.collections.new(name=collection_name)
+        context.scene.collection.children.link(collection)
+    for scene_object in scene_objects:
+        # remove the scene_object from the collections it is in
+        for user_collection in scene_object.users_collection:
+            if user_collection != collection:
+                user_collection.objects.unlink(scene_object)
+        # add the scene_object to the proper collection
+        if not collection.objects.get(scene_object.name):
+            collection.objects.link(scene_object)
+
+def get_bones(rig_object):
+    """returns edit bones if rig_object is in Edit Mode, bones otherwise"""
+    if rig_object.mode == 'EDIT':
+        return rig_object.data.edit_bones
+    return rig_object.data.bones
+
+def is_bonename_in_rig_object(rig_object, bonename):
+    return get_bones(rig_object).get(bonename) is not None
+
+def find_bone_by_name_in_rig_object(rig_object, bonename):
+    return get_bones(rig_object).get(bonename)
+
+def search_rigify_deform_bone_true_parent(rig_object, bone):
+    """walks up the hierarchy and returns parent"""
+    ORG_prefix = properties.AddonPreferences.ORG_prefix
+    DEF_prefix = properties.AddonPreferences.DEF_prefix
+    bones = get_bones(rig_object)
+    # root need no parent
+    if bone is bones[0]:
+        return None
+    current_bone = bone
+    current_parent = current_bone.parent
+    while current_parent:
+        if current_parent.use_deform:
+            return current_parent
+        # non-deforming parent.
+        if current_parent.name.startswith(ORG_prefix):
+            # try checking if DEF- alternate of ORG- bone exists and use that as parent
+            bonename_to_check = current_parent.name.replace(ORG_prefix, DEF_prefix)
+            # make sure the DEF- alternate is not self (current_bone) and does exist
+            if bonename_to_check != current_bone.name and is_bonename_in_rig_object(rig_object, bonename_to_check): 
+                bone_to_check = bones[bonename_to_check]
+                if bone_to_check.use_deform:
+                    return bone_to_check
+        # skip to next parent
+        current_bone = current_parent
+        current_parent = current_parent.parent
+    # return root as parent for parentless bones
+    return bones[0]
+
+def build_armature_hierarchy_from_rigify(rig_object, disconnect_all = True, additional_bones = []):
+    """
+    Uses edit bones in Edit Mode, bones otherwise. Additional bones can be added to the hierarchy
+    hierarchy = [[Bonename, Parentname, use_connect, use_local_location, use_inherit_rotation, inherit_scale]]
+    inherit_scale is enum while the rests that are not names are bools
+    """
+    hierarchy = []
+    additional_bonenames = {additional_bone.name for additional_bone in additional_bones}
+    # add all deform bones and additional_bones in a single pass
+    for bone in get_bones(rig_object):
+        if bone.use_deform or bone.name in additional_bonenames:
+            parent = search_rigify_deform_bone_true_parent(rig_object, bone)
+            parentname = ""
+            if parent:
+                parentname = parent.name
+            hierarchy.append([bone.name, parentname, (not disconnect_all) * bone.use_connect, bone.use_local_location, bone.use_inherit_rotation, bone.inherit_scale])
+    return hierarchy
+
+def restore_armature_hierarchy(rig_object, hierarchy):
+    """
+    Should be in Edit Mode
+    hierarchy = [[Bonename, Parentname, use_connect, use_local_location, use_inherit_rotation, inherit_scale]]
+    inherit_scale is enum while the rests that are not names are bools
+    """
+    for line in hierarchy:
+        current_bone = find_bone_by_name_in_rig_object(rig_object, line[0])
+        current_parent = find_bone_by_name_in_rig_object(rig_object, line[1])
+        if not (current_bone and current_parent):
+            continue
+        if current_bone is not current_parent:
+            current_bone.parent = current_parent
+        current_bone.use_connect = line[2]
+        current_bone.use_local_location = line[3]
+        current_bone.use_inherit_rotation = line[4]
+        current_bone.inherit_scale = line[5]
+
+def get_hierarchy_settings(rigify_rig):
+    """returns disconnect_all_bones and additional_bones used to build the hierarchy of rigify_rig"""
+    disconnect_all_bones = (rigify_rig.sr_rigify_properties is None) or rigify_rig.sr_rigify_properties.disconnect_all_bones
+    additional_bones = []
+    if rigify_rig.sr_rigify_properties.have_additional_bones:
+        additional_bones = rigify_rig.sr_rigify_properties.additional_bones
+    return disconnect_all_bones, additional_bones
+
+def get_hierarchy_signature(hierarchy):
+    """returns a hash of hierarchy. Used to know if the bone set of a generated rig changed"""
+    return hashlib.sha1(repr(sorted(tuple(line) for line in hierarchy)).encode()).hexdigest()
+
+def get_hierarchy_bonenames(hierarchy):
+    """returns names of all bones kept by hierarchy (bones and their parents), in hierarchy order"""
+    bonenames = {}
+    for line in hierarchy:
+        for bonename in (line[1], line[0]):
+            if bonename:
+                bonenames[bonename] = None
+    return list(bonenames)
+
+def put_all_bones_into_layer_index(rig_object, layer_index = 0):
+    """put bones into bone layer index"""
+    for bone in rig_object.data.edit_bones:
+        for i in range(32):
+            bone.layers[i] = i == layer_index
+    # disable unused armature layers
+    for i in range(32):
+        rig_object.data.layers[i] = i == layer_index
+
+def constrain_bone_to_rigify(pose_bone, rigify_rig, subtarget):
+    """constrain pose_bone to the subtarget bone of rigify_rig"""
+    copyloc = pose_bone.constraints.new(type='COPY_LOCATION')
+    copyloc.name = properties.AddonPreferences.prefix + 'COPY_LOCATION'
+    copyloc.target = rigify_rig
+    copyloc.subtarget = subtarget
+    copyloc.enabled = True
+    copyrot = pose_bone.constraints.new(type='COPY_ROTATION')
+    copyrot.name = properties.AddonPreferences.prefix + 'COPY_ROTATION'
+    copyrot.target = rigify_rig
+    copyrot.subtarget = subtarget
+    copyrot.enabled = True
+
+def constrain_rig_to_rigify(gameready_rig, rigify_rig):
+    """assumes the rig bones still has matching names to the rigify bones"""
+    for bone in gameready_rig.pose.bones:
+        constrain_bone_to_rigify(bone, rigify_rig, bone.name)
+
+def toggle_gameready_rig_constraints(gameready_rig, enabled = True):
+    """enables/disables the gameready rig constraints to origin rigify"""
+    constraint_names = [properties.AddonPreferences.prefix + 'COPY_LOCATION', properties.AddonPreferences.prefix + 'COPY_ROTATION']
+    for bone in gameready_rig.pose.bones:
+        for constraint in bone.constraints:
+            if constraint.name in constraint_names:
+                constraint.enabled = enabled
+
+def parent_meshes_to_rig(new_rig, old_rig, meshes):
+    """make all armature modifiers point to new_rig"""
+    for mesh in meshes:
+        # reset modifier
+        for modifier in mesh.modifiers:
+            if modifier.type == 'ARMATURE' and modifier.object is old_rig:
+                mesh.modifiers.remove(modifier)
+        # set new parent
+        mesh.parent = new_rig
+        # reset locrotscale
+        mesh.location, mesh.rotation_euler, mesh.scale = (0., 0., 0.), (0., 0., 0.), (1., 1., 1.)
+        # create new armature modifier and points to new_rig
+        new_modifier = mesh.modifiers.new(name=new_rig.name, type='ARMATURE')
+        new_modifier.object = new_rig
+
+def get_sanitized_bone_name(bone):
+    """returns the name of bone without prefix if it is a deform bone"""
+    addonprefs = properties.AddonPreferences
+    prefixes = (addonprefs.ORG_prefix, addonprefs.DEF_prefix, addonprefs.MCH_prefix, addonprefs.VIS_prefix)
+    if bone.use_deform and any(bone.name.startswith(prefix := pr) for pr in prefixes):
+        return bone.name.removeprefix(prefix)
+    return bone.name
+
+def remove_bone_prefixes(rig_object):
+    """removes prefixes on deform bones"""
+    for bone in rig_object.data.bones:
+        sanitized_name = get_sanitized_bone_name(bone)
+        if sanitized_name != bone.name:
+            bone.name = sanitized_name
+
+def get_rig_datablocks(rig_object, actions = False, meshes = False):
+    """returns the rig and its data, optionally with all its actions and all meshes parented to it"""
+    datablocks = {rig_object, rig_object.data}
+    if actions and rig_object.animation_data:
+        datablocks.update(strip.action for track in rig_object.animation_data.nla_tracks for strip in track.strips if strip.action)
+    if meshes:
+        for mesh in rig_object.children:
+            if mesh.type == 'MESH':
+                datablocks.add(mesh)
+                if mesh.data and mesh.data.users == 1:
+                    datablocks.add(mesh.data)
+    return datablocks
+
+def delete_rig(rig_object, delete_actions = False, delete_meshes = False):
+    """delete the rig and optionally all actions and all meshes parented to it, in a single batch"""
+    # batch_remove only rebuilds relations once instead of once per datablock
+    bpy.data.batch_remove(get_rig_datablocks(rig_object, delete_actions, delete_meshes))
+
+# bpy.data collections of datablocks the addon creates, by id_type
+generated_data_collections = {'OBJECT': "objects", 'MESH': "meshes", 'ARMATURE': "armatures", 'ACTION': "actions"}
+
+# pointer of generated datablock records, by id_type
+generated_data_pointers = {'OBJECT': "object", 'MESH': "mesh", 'ARMATURE': "armature", 'ACTION': "action"}
+
+def register_generated_datablock(rigify_rig, datablock):
+    """remember that datablock was created for rigify_rig so that it is always freed. Returns datablock"""
+    data_pointer = generated_data_pointers[datablock.id_type]
+    generated_datablocks = rigify_rig.sr_rigify_properties.generated_datablocks
+    if not any(getattr(record, data_pointer) == datablock for record in generated_datablocks):
+        setattr(generated_datablocks.add(), data_pointer, datablock)
+    return datablock
+
+def get_record_datablock(record):
+    """returns the datablock of a generated datablock record, or None if it was removed"""
+    return record.object or record.mesh or record.armature or record.action
+
+def get_generated_datablocks(rigify_rig):
+    """returns the datablocks registered for rigify_rig that still exist"""
+    datablocks = set()
+    for record in rigify_rig.sr_rigify_properties.generated_datablocks:
+        datablock = get_record_datablock(record)
+        if datablock is not None:
+            datablocks.add(datablock)
+    return datablocks
+
+def count_registered_users(datablock, rigify_rig):
+    """returns how many users of datablock come from the generated datablock records of rigify_rig"""
+    return sum(get_record_datablock(record) == datablock for record in rigify_rig.sr_rigify_properties.generated_datablocks)
+
+def remove_empty_addon_collection():
+    """remove the addon collection once nothing is generated anymore"""
+    collection = bpy.data.collections.get(properties.AddonPreferences.collection_name)
+    if collection is not None and not collection.all_objects and not collection.children:
+        bpy.data.collections.remove(collection)
+
+def forget_foreign_generated_data(rigify_rig):
+    """
+    forget generated data of rigify_rig that belongs to another rig.
+    Duplicating a rigify rig copies its generated rig, records and baked tracks, which still point to the data generated for the original
+    """
+    rigify_properties = rigify_rig.sr_rigify_properties
+    gameready_rig = rigify_properties.generated_rig
+    if gameready_rig is not None and gameready_rig.sr_origin is not rigify_rig:
+        rigify_properties.generated_rig = None
+        rigify_properties.generated_datablocks.clear()
+        rigify_properties.baked_tracks.clear()
+        rigify_properties.hierarchy_signature = ""
+        rigify_properties.settings_signature = ""
+        return
+    # datablocks owned by generated rigs of other rigify rigs
+    foreign_datablocks = set()
+    for record in rigify_properties.generated_datablocks:
+        if record.object is not None and record.object.sr_origin is not None and record.object.sr_origin is not rigify_rig:
+            foreign_datablocks |= get_rig_datablocks(record.object, True, True)
+    if not foreign_datablocks:
+        return
+    generated_datablocks = rigify_properties.generated_datablocks
+    for index in reversed(range(len(generated_datablocks))):
+        if get_record_datablock(generated_datablocks[index]) in foreign_datablocks:
+            generated_datablocks.remove(index)
+    baked_tracks = rigify_properties.baked_tracks
+    for index in reversed(range(len(baked_tracks))):
+        if baked_tracks[index].action in foreign_datablocks:
+            baked_tracks.remove(index)
+
+def free_generated_data(context, rigify_rig):
+    """remove everything generated for rigify_rig (registered datablocks, generated rig, its actions and meshes) and show rigify again"""
+    rigify_properties = rigify_rig.sr_rigify_properties
+    deselect_all(context)
+    forget_foreign_generated_data(rigify_rig)
+    gameready_rig = rigify_properties.generated_rig
+    datablocks = get_generated_datablocks(rigify_rig)
+    if gameready_rig is not None:
+        datablocks |= get_rig_datablocks(gameready_rig, True, True)
+    datablocks.discard(rigify_rig)
+    # keep baked actions shared with other rigs
+    for datablock in list(datablocks):
+        if isinstance(datablock, bpy.types.Action) and is_action_shared(datablock, gameready_rig, rigify_rig):
+            datablocks.discard(datablock)
+    bpy.data.batch_remove(datablocks)
+    remove_empty_addon_collection()
+    rigify_properties.generated_rig = None
+    rigify_properties.generated_datablocks.clear()
+    rigify_properties.baked_tracks.clear()
+    rigify_properties.hierarchy_signature = ""
+    # unhide meshes parented to rigify
+    for mesh in rigify_rig.children:
+        if mesh.type == 'MESH':
+            mesh.hide_viewport = False
+            mesh.hide_set(False)
+    rigify_rig.hide_viewport = False
+    rigify_rig.hide_set(False)
+
+def find_leaked_datablocks(context):
+    """returns datablocks generated by the addon that no previewing rig owns anymore"""
+    owned = set()
+    for rigify_rig in bpy.data.objects:
+        if properties.is_rigify(None, rigify_rig):
+            if rigify_rig.sr_rigify_properties.generated_rig is not None:
+                owned |= get_generated_datablocks(rigify_rig)
+                owned |= get_rig_datablocks(rigify_rig.sr_rigify_properties.generated_rig, True, True)
+    leaked = []
+    for data_collection in generated_data_collections.values():
+        for datablock in getattr(bpy.data, data_collection):
+            if datablock in owned:
+                continue
+            # generated rig not used by its origin anymore, or prefixed datablock without users
+            if (data_collection == "objects" and properties.is_generated_rig(None, datablock)) \
+                or (datablock.name.startswith(properties.AddonPreferences.prefix) and datablock.users == 0):
+                leaked.append(datablock)
+    return leaked
+
+def get_tracks_to_bake(source_rig):
+    """return all nla tracks that are not muted"""
+    if not source_rig.animation_data or not source_rig.animation_data.nla_tracks:
+        return []
+    if any((solo_track := track).is_solo for track in source_rig.animation_data.nla_tracks):
+        return [solo_track]
+    return [track for track in source_rig.animation_data.nla_tracks if track.mute == False]
+
+def get_track_name(track, animation_naming):
+    """returns track name or first strip name"""
+    # track with empty strip uses track name
+    if animation_naming == 'STRIP' and track.strips:
+        return track.strips[0].name
+    return track.name
+
+def get_nla_track_frame_range(nla_track):
+    """returns frame start and end of nla_track"""
+    frame_start = inf
+    frame_end = -inf
+    for strip in nla_track.strips:
+        if strip.frame_start < frame_start:
+            frame_start = strip.frame_start
+        if strip.frame_end > frame_end:
+            frame_end = strip.frame_end
+    return int(frame_start), int(frame_end)
+
+def create_game_ready_rig(context, rigify_rig):
+    """generate the game-ready rig"""
+    deselect_all(context)
+    # duplicate rigify
+    gameready_rig_data = rigify_rig.data.copy()
+    gameready_rig_data.name = properties.AddonPreferences.prefix + rigify_rig.data.name
+    gameready_rig = bpy.data.objects.new(name = gameready_rig_data.name, object_data = gameready_rig_data)
+    register_generated_datablock(rigify_rig, gameready_rig_data)
+    register_generated_datablock(rigify_rig, gameready_rig)
+    with context.temp_override(selected_objects = [gameready_rig], active_object = gameready_rig):
+        bpy.ops.object.make_local(type = 'SELECT_OBDATA')
+    # set position if not recentering (recenter just stays at 0. 0. 0.)
+    if rigify_rig.sr_rigify_properties.recenter:
+        gameready_rig.location, gameready_rig.rotation_euler = (0., 0., 0.), (0., 0., 0.)
+    else:
+        gameready_rig.location, gameready_rig.rotation_euler = rigify_rig.location.copy(), rigify_rig.rotation_euler.copy()
+    # duplicate meshes parented to rigify that are not hidden
+    meshes = []
+    for orig_mesh in rigify_rig.children:
+        if (orig_mesh.type == 'MESH' and orig_mesh.hide_viewport == False and not orig_mesh.hide_get()):
+            new_data = orig_mesh.data.copy()
+            new_data.name = properties.AddonPreferences.prefix + orig_mesh.data.name
+            new_mesh = bpy.data.objects.new(name = new_data.name, object_data = new_data)
+            register_generated_datablock(rigify_rig, new_data)
+            register_generated_datablock(rigify_rig, new_mesh)
+            with context.temp_override(selected_objects = [new_mesh], active_object = new_mesh):
+                bpy.ops.object.make_local(type = 'SELECT_OBDATA')
+            meshes.append(new_mesh)
+            # also hide originals
+            orig_mesh.hide_viewport = True
+            orig_mesh.hide_set(True)
+    # add new rig and meshes to correct collection at once
+    add_scene_objects_to_collection(context, [gameready_rig] + meshes, properties.AddonPreferences.collection_name)
+    # remove rigify ID (rig_id)
+    del gameready_rig.data[properties.AddonPreferences.rigify_id_prop_name]
+    # build hierarchy
+    gameready_rig.select_set(True)
+    context.view_layer.objects.active = gameready_rig
+    bpy.ops.object.mode_set(mode = 'EDIT', toggle = False)
+    disconnect_all_bones, additional_bones = get_hierarchy_settings(rigify_rig)
+    hierarchy = build_armature_hierarchy_from_rigify(gameready_rig, disconnect_all_bones, additional_bones)
+    rigify_rig.sr_rigify_properties.hierarchy_signature = get_hierarchy_signature(hierarchy)
+    # remove animation data incl. drivers
+    gameready_rig.data.animation_data_clear()
+    # remove all bones that are not in hierarchy
+    hierarchy_bonenames = set(get_hierarchy_bonenames(hierarchy))
+    for bone in gameready_rig.data.edit_bones:
+        if bone.name not in hierarchy_bonenames:
+            gameready_rig.data.edit_bones.remove(bone)
+    put_all_bones_into_layer_index(gameready_rig, 0)
+    # restore hierarchy (destroyed when removing bones above)
+    restore_armature_hierarchy(gameready_rig, hierarchy)
+    # unhide bones & reset bbone segments
+    bpy.ops.object.mode_set(mode = 'OBJECT', toggle = False)
+    for bone in gameready_rig.data.bones:
+        bone.hide = False
+        bone.bbone_segments = 1
+    # add LocRot constraints
+    constrain_rig_to_rigify(gameready_rig, rigify_rig)
+    # parent copied meshes to generated gameready_rig, with empty groups
+    parent_meshes_to_rig(gameready_rig, rigify_rig, meshes)
+    # fix bone names. Some things (e.g. UE Control Rig) are messed up if bones have DEF- prefix (any other prefix??)
+    remove_bone_prefixes(gameready_rig)
+    # save origin rigify on generated rig and vice versa
+    gameready_rig.sr_origin = rigify_rig
+    rigify_rig.sr_rigify_properties.generated_rig = gameready_rig
+    return gameready_rig
+
+def update_game_ready_rig(context, rigify_rig, gameready_rig):
+    """
+    update the game-ready rig in place: only add/remove bones that changed in the planned hierarchy, then restore the hierarchy
+    Returns number of added and removed bones
+    """
+    deselect_all(context)
+    rigify_properties = rigify_rig.sr_rigify_properties
+    disconnect_all_bones, additional_bones = get_hierarchy_settings(rigify_rig)
+    hierarchy = build_armature_hierarchy_from_rigify(rigify_rig, disconnect_all_bones, additional_bones)
+    hierarchy_signature = get_hierarchy_signature(hierarchy)
+    if hierarchy_signature == rigify_properties.hierarchy_signature:
+        return 0, 0
+    # diff planned bones against current bones, using names once prefixes are removed
+    source_bones = get_bones(rigify_rig)
+    sanitized_names = {bonename: get_sanitized_bone_name(source_bones[bonename]) for bonename in get_hierarchy_bonenames(hierarchy)}
+    current_bonenames = {bone.name for bone in gameready_rig.data.bones}
+    planned_bonenames = set(sanitized_names.values())
+    bonenames_to_remove = [bonename for bonename in current_bonenames if bonename not in planned_bonenames]
+    bonenames_to_add = [bonename for bonename, sanitized_name in sanitized_names.items() if sanitized_name not in current_bonenames]
+    # new bones keep their rigify name until prefixes are removed, so that vertex groups follow the renaming
+    edit_names = {bonename: bonename if bonename in bonenames_to_add else sanitized_name for bonename, sanitized_name in sanitized_names.items()}
+    edit_hierarchy = [[edit_names[line[0]], edit_names.get(line[1], "")] + line[2:] for line in hierarchy]
+    gameready_rig.select_set(True)
+    context.view_layer.objects.active = gameready_rig
+    bpy.ops.object.mode_set(mode = 'EDIT', toggle = False)
+    edit_bones = gameready_rig.data.edit_bones
+    for bonename in bonenames_to_remove:
+        edit_bones.remove(edit_bones[bonename])
+    for bonename in bonenames_to_add:
+        source_bone = source_bones[bonename]
+        new_bone = edit_bones.new(bonename)
+        new_bone.head, new_bone.tail = source_bone.head_local, source_bone.tail_local
+        new_bone.matrix = source_bone.matrix_local
+        new_bone.use_deform = source_bone.use_deform
+        new_bone.bbone_segments = 1
+        new_bone.layers = [i == 0 for i in range(32)]
+    restore_armature_hierarchy(gameready_rig, edit_hierarchy)
+    bpy.ops.object.mode_set(mode = 'OBJECT', toggle = False)
+    # constrain new bones to their rigify bone
+    for bonename in bonenames_to_add:
+        gameready_rig.data.bones[bonename].hide = False
+        constrain_bone_to_rigify(gameready_rig.pose.bones[bonename], rigify_rig, bonename)
+    remove_bone_prefixes(gameready_rig)
+    rigify_properties.hierarchy_signature = hierarchy_signature
+    return len(bonenames_to_add), len(bonenames_to_remove)
+
+def get_action_digest(action):
+    """returns a hash of the keyframes of action"""
+    digest = hashlib.sha1()
+    for fcurve in action.fcurves:
+        digest.update(repr((fcurve.data_path, fcurve.array_index, fcurve.mute)).encode())
+        keyframes = array.array('f', [0.]) * (len(fcurve.keyframe_points) * 2)
+        for attribute in ('co', 'handle_left', 'handle_right'):
+            fcurve.keyframe_points.foreach_get(attribute, keyframes)
+            digest.update(keyframes.tobytes())
+    return digest.digest()
+
+def get_rest_pose_digest(rig_object):
+    """returns a hash of the rest pose of rig_object bones"""
+    matrices = np.empty(len(rig_object.data.bones) * 16, dtype = np.float32)
+    rig_object.data.bones.foreach_get("matrix_local", matrices)
+    return hashlib.sha1(matrices.tobytes()).digest()
+
+# UI state of constraints, not affecting the evaluated pose
+ui_property_names = {"active", "show_expanded"}
+# pose bone channels keeping their current value when not keyed
+pose_bone_channel_names = ("location", "rotation_quaternion", "rotation_euler", "rotation_axis_angle", "scale")
+
+def get_rna_values(struct, data_path = "", excluded_paths = ()):
+    """returns the editable RNA property values of struct (e.g. a constraint) except excluded_paths, ID pointers by name"""
+    values = []
+    for rna_property in struct.bl_rna.properties:
+        if rna_property.is_readonly or rna_property.type == 'COLLECTION' or rna_property.identifier in ui_property_names \
+            or data_path + rna_property.identifier in excluded_paths:
+            continue
+        value = getattr(struct, rna_property.identifier)
+        if rna_property.type == 'POINTER':
+            value = value.name_full if isinstance(value, bpy.types.ID) else None
+        elif rna_property.type == 'ENUM' and rna_property.is_enum_flag:
+            value = tuple(sorted(value))
+        elif getattr(rna_property, "is_array", False):
+            value = tuple(value)
+        values.append((rna_property.identifier, value))
+    return values
+
+def get_custom_property_values(struct, data_path = "", excluded_paths = ()):
+    """returns the custom property values of struct (e.g. rigify IK/FK switches of a pose bone) except excluded_paths, without the addon's own properties"""
+    return [(key, value.to_dict() if hasattr(value, "to_dict") else value.to_list() if hasattr(value, "to_list") else value)
+        for key, value in sorted(struct.items())
+        if not key.startswith(properties.AddonPreferences.prefix) and data_path + '["' + bpy.utils.escape_identifier(key) + '"]' not in excluded_paths]
+
+def get_drivers_values(id_data):
+    """returns the drivers of id_data, with their expression and variables"""
+    if id_data.animation_data is None:
+        return []
+    return [(fcurve.data_path, fcurve.array_index, fcurve.mute, fcurve.driver.type, fcurve.driver.expression,
+        [(variable.name, variable.type, [get_rna_values(target) for target in variable.targets]) for variable in fcurve.driver.variables])
+        for fcurve in id_data.animation_data.drivers]
+
+def get_animated_paths(rig_object):
+    """returns data paths of rig_object animated by any of its actions or driven, whose current value depends on the current frame"""
+    animation_data = rig_object.animation_data
+    if animation_data is None:
+        return set()
+    actions = {strip.action for track in animation_data.nla_tracks for strip in track.strips if strip.action}
+    if animation_data.action:
+        actions.add(animation_data.action)
+    animated_paths = {fcurve.data_path for action in actions for fcurve in action.fcurves}
+    animated_paths.update(fcurve.data_path for fcurve in animation_data.drivers)
+    return animated_paths
+
+def get_pose_state_digest(rig_object):
+    """
+    returns a hash of the state of rig_object that is not animated but changes the evaluated pose:
+    unkeyed pose channels, custom properties (e.g. IK/FK switches, follow, stretch), constraint settings and drivers.
+    Animated and driven values are left out as they depend on the current frame
+    """
+    animated_paths = get_animated_paths(rig_object)
+    digest = hashlib.sha1()
+    digest.update(repr((get_custom_property_values(rig_object, "", animated_paths), get_drivers_values(rig_object), get_drivers_values(rig_object.data))).encode())
+    for pose_bone in rig_object.pose.bones:
+        data_path = get_bone_data_path(pose_bone)
+        channels = [(channel_name, tuple(getattr(pose_bone, channel_name))) for channel_name in pose_bone_channel_names if data_path + channel_name not in animated_paths]
+        constraints = [get_rna_values(constraint, data_path + 'constraints["' + bpy.utils.escape_identifier(constraint.name) + '"].', animated_paths) for constraint in pose_bone.constraints]
+        digest.update(repr((pose_bone.name, pose_bone.rotation_mode, channels, get_custom_property_values(pose_bone, data_path[:-1], animated_paths), constraints)).encode())
+    return digest.digest()
+
+def get_object_state_digest(rig_object):
+    """
+    returns a hash of the object level state of rig_object that changes its world space pose, and so the baked (world space constrained) pose:
+    parent, delta transforms and object constraints. Location and rotation are left out, they are recentered or copied to the generated rig
+    """
+    animated_paths = get_animated_paths(rig_object)
+    constraints = [get_rna_values(constraint, 'constraints["' + bpy.utils.escape_identifier(constraint.name) + '"].', animated_paths) for constraint in rig_object.constraints]
+    parent = (rig_object.parent.name_full, rig_object.parent_type, rig_object.parent_bone, tuple(value for row in rig_object.matrix_parent_inverse for value in row)) if rig_object.parent else None
+    deltas = (tuple(rig_object.delta_location), tuple(rig_object.delta_rotation_euler), tuple(rig_object.delta_rotation_quaternion), tuple(rig_object.delta_scale))
+    return hashlib.sha1(repr((parent, deltas, constraints)).encode()).digest()
+
+def get_rig_digest(rig_object):
+    """returns a hash of everything of rig_object that affects baking, besides its animations"""
+    return get_rest_pose_digest(rig_object) + get_pose_state_digest(rig_object) + get_object_state_digest(rig_object)
+
+def get_bake_key(source_rig, track, rig_digest = None):
+    """
+    returns a hash of everything that affects the baked action of track, except its name.
+    Tracks (of any rig) with the same bake key share the same baked action
+    """
+    rigify_properties = source_rig.sr_rigify_properties
+    key = hashlib.sha1()
+    key.update(repr((rigify_properties.hierarchy_signature, rigify_properties.recenter, tuple(source_rig.scale), rigify_properties.compact_channels,
+        rigify_properties.root_motion, rigify_properties.root_motion_bone, rigify_properties.root_motion_hips)).encode())
+    key.update(rig_digest or get_rig_digest(source_rig))
+    key.update(properties.get_strips_signature(track, names = False).encode())
+    for strip in track.strips:
+        if strip.action:
+            key.update(get_action_digest(strip.action))
+    return key.hexdigest()
+
+def get_track_signature(source_rig, track, bake_key = None):
+    """returns a hash of everything that affects the baked result of track"""
+    rigify_properties = source_rig.sr_rigify_properties
+    signature = hashlib.sha1()
+    signature.update(repr((get_track_name(track, rigify_properties.animation_naming), properties.get_strips_signature(track))).encode())
+    signature.update((bake_key or get_bake_key(source_rig, track)).encode())
+    return signature.hexdigest()
+
+def get_baked_actions_by_bake_key():
+    """returns (baked action, True if root motion was skipped) of all previewing rigs, by bake key"""
+    baked_actions = {}
+    for rigify_rig in bpy.data.objects:
+        if properties.is_rigify(None, rigify_rig) and rigify_rig.sr_rigify_properties.generated_rig is not None:
+            for baked_track in rigify_rig.sr_rigify_properties.baked_tracks:
+                if baked_track.action and baked_track.bake_key:
+                    baked_actions[baked_track.bake_key] = (baked_track.action, baked_track.is_root_motion_skipped)
+    return baked_actions
+
+def count_action_users(action, gameready_rig, rigify_rig):
+    """returns how many users of action come from gameready_rig strips and rigify_rig baked tracks and records"""
+    users = sum(baked_track.action == action for baked_track in rigify_rig.sr_rigify_properties.baked_tracks) + count_registered_users(action, rigify_rig)
+    if gameready_rig is not None and gameready_rig.animation_data:
+        users += sum(strip.action == action for track in gameready_rig.animation_data.nla_tracks for strip in track.strips)
+    return users
+
+def is_action_shared(action, gameready_rig, rigify_rig):
+    """returns True if action is also used outside of gameready_rig and rigify_rig (e.g. baked once for several rigs)"""
+    return action.users - action.use_fake_user > count_action_users(action, gameready_rig, rigify_rig)
+
+def remove_baked_track(source_rig, target_rig, baked_track):
+    """remove the nla track of baked_track from target_rig, and its action if nothing else uses it"""
+    if target_rig.animation_data:
+        nla_track = target_rig.animation_data.nla_tracks.get(baked_track.name)
+        if nla_track:
+            target_rig.animation_data.nla_tracks.remove(nla_track)
+    # the only users left are baked_track itself and the generated datablock records of source_rig
+    if baked_track.action and baked_track.action.users - baked_track.action.use_fake_user <= 1 + count_registered_users(baked_track.action, source_rig):
+        baked_track.action.user_clear()
+        bpy.data.actions.remove(baked_track.action)
+
+def sync_baked_tracks(source_rig, target_rig):
+    """remove baked tracks that are stale or not baked anymore, and return source tracks that need to be (re)baked"""
+    rigify_properties = source_rig.sr_rigify_properties
+    tracks_to_bake = []
+    if rigify_properties.export_mode != 'ARMATURE':
+        tracks_to_bake = get_tracks_to_bake(source_rig)
+    rig_digest = get_rig_digest(source_rig)
+    signatures = {track.name: get_track_signature(source_rig, track, get_bake_key(source_rig, track, rig_digest)) for track in tracks_to_bake}
+    up_to_date = set()
+    baked_tracks = rigify_properties.baked_tracks
+    for index in reversed(range(len(baked_tracks))):
+        baked_track = baked_tracks[index]
+        if baked_track.action and signatures.get(baked_track.track_name) == baked_track.signature:
+            up_to_date.add(baked_track.track_name)
+            baked_track.is_stale = False
+            continue
+        remove_baked_track(source_rig, target_rig, baked_track)
+        baked_tracks.remove(index)
+    return [track for track in tracks_to_bake if track.name not in up_to_date]
+
+def get_pose_bone_channels(pose_bone):
+    """returns (data_path, array_length) of the location, rotation and scale channels keyed when baking pose_bone"""
+    data_path = get_bone_data_path(pose_bone)
+    if pose_bone.rotation_mode == 'QUATERNION':
+        rotation = ("rotation_quaternion", 4)
+    elif pose_bone.rotation_mode == 'AXIS_ANGLE':
+        rotation = ("rotation_axis_angle", 4)
+    else:
+        rotation = ("rotation_euler", 3)
+    return [(data_path + "location", 3), (data_path + rotation[0], rotation[1]), (data_path + "scale", 3)]
+
+def bake_action_windowed(context, target_rig, action, frame_start, frame_end, window_size):
+    """
+    visual bake of the pose of target_rig into action, window_size frames at a time.
+    Each window is flushed into a temporary file, then F-curves are filled channel by channel, so memory is bounded by window size instead of clip length
+    """
+    scene = context.scene
+    prev_frame, prev_subframe = scene.frame_current, scene.frame_subframe
+    pose_bones = list(target_rig.pose.bones)
+    channel_count = sum(array_length for pose_bone in pose_bones for _, array_length in get_pose_bone_channels(pose_bone))
+    itemsize = array.array('f').itemsize
+    # previous rotations, to keep quaternions and eulers continuous across frames and windows
+    prev_rotations = {}
+    windows = []
+    with tempfile.TemporaryFile() as buffer:
+        for window_start in range(frame_start, frame_end + 1, window_size):
+            window_length = min(window_size, frame_end + 1 - window_start)
+            window = [array.array('f') for _ in range(channel_count)]
+            for frame in range(window_start, window_start + window_length):
+                scene.frame_set(frame)
+                channel_index = 0
+                for pose_bone in pose_bones:
+                    matrix = target_rig.convert_space(pose_bone = pose_bone, matrix = pose_bone.matrix, from_space = 'POSE', to_space = 'LOCAL')
+                    location, quaternion, scale = matrix.decompose()
+                    prev_rotation = prev_rotations.get(pose_bone.name)
+                    if pose_bone.rotation_mode in ('QUATERNION', 'AXIS_ANGLE'):
+                        if prev_rotation is not None:
+                            quaternion.make_compatible(prev_rotation)
+                        prev_rotations[pose_bone.name] = quaternion
+                        rotation = quaternion
+                        if pose_bone.rotation_mode == 'AXIS_ANGLE':
+                            axis, angle = quaternion.to_axis_angle()
+                            rotation = (angle, *axis)
+                    else:
+                        if prev_rotation is not None:
+                            rotation = matrix.to_euler(pose_bone.rotation_mode, prev_rotation)
+                        else:
+                            rotation = matrix.to_euler(pose_bone.rotation_mode)
+                        prev_rotations[pose_bone.name] = rotation
+                    for value in (*location, *rotation, *scale):
+                        window[channel_index].append(value)
+                        channel_index += 1
+            # flush window (channel-major) and release it
+            windows.append((buffer.tell(), window_length))
+            for channel_values in window:
+                channel_values.tofile(buffer)
+            del window
+        # fill F-curves one channel at a time
+        frames = array.array('f', range(frame_start, frame_end + 1))
+        keyframes = array.array('f', [0.]) * (len(frames) * 2)
+        keyframes[0::2] = frames
+        channel_index = 0
+        for pose_bone in pose_bones:
+            for data_path, array_length in get_pose_bone_channels(pose_bone):
+                for array_index in range(array_length):
+                    values = array.array('f')
+                    for window_offset, window_length in windows:
+                        buffer.seek(window_offset + channel_index * window_length * itemsize)
+                        values.fromfile(buffer, window_length)
+                    keyframes[1::2] = values
+                    fcurve = action.fcurves.new(data_path, index = array_index, action_group = pose_bone.name)
+                    fcurve.keyframe_points.add(len(frames))
+                    fcurve.keyframe_points.foreach_set("co", keyframes)
+                    fcurve.update()
+                    channel_index += 1
+    scene.frame_set(prev_frame, subframe = prev_subframe)
+
+def make_quaternions_continuous(action):
+    """flip quaternion keyframes so that each stays in the same hemisphere as the previous one, one whole bone at a time"""
+    quaternion_fcurves = {}
+    for fcurve in action.fcurves:
+        if fcurve.data_path.endswith("rotation_quaternion"):
+            quaternion_fcurves.setdefault(fcurve.data_path, [None] * 4)[fcurve.array_index] = fcurve
+    for fcurves in quaternion_fcurves.values():
+        if None in fcurves or len({len(fcurve.keyframe_points) for fcurve in fcurves}) != 1:
+            continue
+        keyframes = np.empty((4, len(fcurves[0].keyframe_points) * 2), dtype = np.float32)
+        for fcurve, fcurve_keyframes in zip(fcurves, keyframes):
+            fcurve.keyframe_points.foreach_get("co", fcurve_keyframes)
+        quaternions = keyframes[:, 1::2]
+        # a negative dot product with the previous quaternion means the sign flipped
+        flips = np.einsum('ij,ij->j', quaternions[:, 1:], quaternions[:, :-1]) < 0.
+        if not flips.any():
+            continue
+        quaternions[:, 1:] *= np.where(np.cumsum(flips) % 2, -1., 1.)
+        for fcurve, fcurve_keyframes in zip(fcurves, keyframes):
+            fcurve.keyframe_points.foreach_set("co", fcurve_keyframes)
+            fcurve.update()
+
+def compact_constant_channels(action, tolerance = 1e-5):
+    """replace channels that do not change (e.g. the still axes of a bone rotating about a single axis) with their first and last keyframes"""
+    for fcurve in list(action.fcurves):
+        keyframe_count = len(fcurve.keyframe_points)
+        if keyframe_count < 3:
+            continue
+        keyframes = np.empty(keyframe_count * 2, dtype = np.float32)
+        fcurve.keyframe_points.foreach_get("co", keyframes)
+        if np.ptp(keyframes[1::2]) > tolerance:
+            continue
+        # first and last keyframes keep the frame range of the action
+        compact_keyframes = keyframes[[0, 1, -2, -1]]
+        data_path, array_index = fcurve.data_path, fcurve.array_index
+        group_name = fcurve.group.name if fcurve.group else ""
+        action.fcurves.remove(fcurve)
+        compact_fcurve = action.fcurves.new(data_path, index = array_index, action_group = group_name)
+        compact_fcurve.keyframe_points.add(2)
+        compact_fcurve.keyframe_points.foreach_set("co", compact_keyframes)
+        compact_fcurve.update()
+
+def read_fcurves(action, data_path, array_length):
+    """returns the values of the array_length F-curves of data_path as a (array_length, frames) array, or None if they are missing or not aligned"""
+    fcurves = [action.fcurves.find(data_path, index = array_index) for array_index in range(array_length)]
+    if None in fcurves or len({len(fcurve.keyframe_points) for fcurve in fcurves}) != 1:
+        return None
+    keyframes = np.empty((array_length, len(fcurves[0].keyframe_points) * 2), dtype = np.float32)
+    for fcurve, fcurve_keyframes in zip(fcurves, keyframes):
+        fcurve.keyframe_points.foreach_get("co", fcurve_keyframes)
+    return keyframes[:, 1::2].astype(np.float64)
+
+def write_fcurves(action, data_path, values):
+    """write values (array_length, frames) into the existing F-curves of data_path"""
+    for array_index, fcurve_values in enumerate(values):
+        fcurve = action.fcurves.find(data_path, index = array_index)
+        keyframes = np.empty(len(fcurve.keyframe_points) * 2, dtype = np.float32)
+        fcurve.keyframe_points.foreach_get("co", keyframes)
+        keyframes[1::2] = fcurve_values
+        fcurve.keyframe_points.foreach_set("co", keyframes)
+        fcurve.update()
+
+def quaternions_to_matrices(quaternions):
+    """(frames, 4) normalized wxyz quaternions to (frames, 3, 3) rotation matrices"""
+    w, x, y, z = quaternions.T
+    return np.stack([
+        np.stack([1. - 2. * (y * y + z * z), 2. * (x * y - z * w), 2. * (x * z + y * w)], axis = -1),
+        np.stack([2. * (x * y + z * w), 1. - 2. * (x * x + z * z), 2. * (y * z - x * w)], axis = -1),
+        np.stack([2. * (x * z - y * w), 2. * (y * z + x * w), 1. - 2. * (x * x + y * y)], axis = -1)
+    ], axis = 1)
+
+def matrices_to_quaternions(matrices):
+    """
+    (frames, 3, 3) rotation matrices to (frames, 4) wxyz quaternions.
+    Shepperd's method: each frame is solved from its largest of w, x, y, z so that signs stay correct near 180 degree rotations
+    """
+    m = matrices
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+    # 4 * w^2, 4 * x^2, 4 * y^2, 4 * z^2
+    squares = np.stack([1. + trace, 1. + 2. * m[:, 0, 0] - trace, 1. + 2. * m[:, 1, 1] - trace, 1. + 2. * m[:, 2, 2] - trace], axis = -1)
+    largest = np.argmax(squares, axis = -1)
+    # 2 * largest component, then the other ones from the symmetric and antisymmetric parts divided by it
+    s = np.sqrt(np.maximum(squares[np.arange(len(m)), largest], 1e-12))
+    wx, wy, wz = m[:, 2, 1] - m[:, 1, 2], m[:, 0, 2] - m[:, 2, 0], m[:, 1, 0] - m[:, 0, 1]
+    xy, xz, yz = m[:, 0, 1] + m[:, 1, 0], m[:, 0, 2] + m[:, 2, 0], m[:, 1, 2] + m[:, 2, 1]
+    candidates = np.stack([
+        np.stack([s * s, wx, wy, wz], axis = -1),
+        np.stack([wx, s * s, xy, xz], axis = -1),
+        np.stack([wy, xy, s * s, yz], axis = -1),
+        np.stack([wz, xz, yz, s * s], axis = -1)
+    ], axis = 1)
+    quaternions = candidates[np.arange(len(m)), largest] / (2. * s[:, None])
+    return quaternions / np.linalg.norm(quaternions, axis = -1, keepdims = True)
+
+def get_bone_data_path(pose_bone):
+    return 'pose.bones["' + bpy.utils.escape_identifier(pose_bone.name) + '"].'
+
+def read_bone_basis_matrices(action, pose_bone):
+    """returns the (frames, 4, 4) basis matrices of pose_bone baked in action, or None if its channels are missing or not quaternions"""
+    if pose_bone.rotation_mode != 'QUATERNION':
+        return None
+    data_path = get_bone_data_path(pose_bone)
+    location = read_fcurves(action, data_path + "location", 3)
+    rotation = read_fcurves(action, data_path + "rotation_quaternion", 4)
+    scale = read_fcurves(action, data_path + "scale", 3)
+    if location is None or rotation is None or scale is None or not location.shape == scale.shape == rotation[:3].shape:
+        return None
+    matrices = np.zeros((location.shape[1], 4, 4))
+    matrices[:, :3, :3] = quaternions_to_matrices((rotation / np.linalg.norm(rotation, axis = 0)).T) * scale.T[:, None, :]
+    matrices[:, :3, 3] = location.T
+    matrices[:, 3, 3] = 1.
+    return matrices
+
+def write_bone_basis_matrices(action, pose_bone, matrices):
+    """write (frames, 4, 4) basis matrices into the baked channels of pose_bone"""
+    data_path = get_bone_data_path(pose_bone)
+    scale = np.linalg.norm(matrices[:, :3, :3], axis = 1)
+    write_fcurves(action, data_path + "location", matrices[:, :3, 3].T)
+    write_fcurves(action, data_path + "rotation_quaternion", matrices_to_quaternions(matrices[:, :3, :3] / scale[:, None, :]).T)
+    write_fcurves(action, data_path + "scale", scale.T)
+
+def extract_root_motion(target_rig, action, root_bonename, hips_bonename):
+    """
+    move the planar translation and yaw of the hips to the root bone, and compensate the children of root, over the whole baked action
+    Assumes bones inherit rotation and scale from their parent. Returns False if the action could not be processed
+    """
+    pose_bones = target_rig.pose.bones
+    root, hips = pose_bones.get(root_bonename), pose_bones.get(hips_bonename)
+    if root is None or hips is None or hips.parent != root:
+        logging.warning("Root motion skipped: " + hips_bonename + " must be a child of " + root_bonename)
+        return False
+    root_basis = read_bone_basis_matrices(action, root)
+    children_basis = {child.name: read_bone_basis_matrices(action, child) for child in root.children}
+    if root_basis is None or any(basis is None for basis in children_basis.values()):
+        logging.warning("Root motion skipped: " + root_bonename + " and its children need baked quaternion channels")
+        return False
+    # armature space matrices of root children over the whole action
+    root_rest = np.array(root.bone.matrix_local)
+    root_pose = root_rest @ root_basis
+    children_offset = {child.name: np.linalg.inv(root_rest) @ np.array(child.bone.matrix_local) for child in root.children}
+    children_pose = {name: root_pose @ children_offset[name] @ basis for name, basis in children_basis.items()}
+    hips_pose = children_pose[hips.name]
+    # yaw of the hips forward axis (-Y, as rigify faces -Y) relative to rest, on the ground plane
+    hips_rest_rotation = np.array(hips.bone.matrix_local)[:3, :3]
+    forward = hips_pose[:, :3, :3] @ (hips_rest_rotation.T @ np.array((0., -1., 0.)))
+    yaw = np.unwrap(np.arctan2(forward[:, 0], -forward[:, 1]))
+    yaw_matrices = np.zeros((len(yaw), 3, 3))
+    yaw_matrices[:, 0, 0], yaw_matrices[:, 0, 1] = np.cos(yaw), -np.sin(yaw)
+    yaw_matrices[:, 1, 0], yaw_matrices[:, 1, 1] = np.sin(yaw), np.cos(yaw)
+    yaw_matrices[:, 2, 2] = 1.
+    new_root_pose = np.zeros_like(root_pose)
+    new_root_pose[:, :3, :3] = yaw_matrices @ root_rest[:3, :3]
+    new_root_pose[:, :2, 3] = hips_pose[:, :2, 3]
+    new_root_pose[:, 3, 3] = 1.
+    # root takes the motion, children keep their armature space pose
+    write_bone_basis_matrices(action, root, np.linalg.inv(root_rest) @ new_root_pose)
+    for child in root.children:
+        write_bone_basis_matrices(action, child, np.linalg.inv(new_root_pose @ children_offset[child.name]) @ children_pose[child.name])
+    return True
+
+def bake_track(context, source_rig, target_rig, track, name):
+    """bake track of source rig into a new action of target rig (selected and active). Returns the action, and True if root motion was skipped"""
+    rigify_properties = source_rig.sr_rigify_properties
+    scene = context.scene
+    prev_frame, prev_subframe = scene.frame_current, scene.frame_subframe
+    frame_start, frame_end = get_nla_track_frame_range(track)
+    # add prefix to action to avoid collision
+    created_action = register_generated_datablock(source_rig, bpy.data.actions.new(str(properties.AddonPreferences.prefix + name)))
+    is_root_motion_skipped = False
+    # always restore solo, active action and frame, even if baking failed
+    try:
+        track.is_solo = True
+        # set active|current before baking
+        target_rig.animation_data.action = created_action
+        if rigify_properties.streaming_bake and frame_end - frame_start + 1 > rigify_properties.bake_window_size:
+            bake_action_windowed(context, target_rig, created_action, frame_start, frame_end, rigify_properties.bake_window_size)
+        else:
+            bpy.ops.nla.bake(
+                frame_start=frame_start
+                , frame_end=frame_end
+                , step=1
+                , only_selected=False
+                , visual_keying=True
+                , clear_constraints=False
+                , clear_parents=False
+                , use_current_action=True
+                , bake_types={'POSE'}
+            )
+        if rigify_properties.root_motion:
+            is_root_motion_skipped = not extract_root_motion(target_rig, created_action, rigify_properties.root_motion_bone, rigify_properties.root_motion_hips)
+        if rigify_properties.compact_channels:
+            make_quaternions_continuous(created_action)
+            compact_constant_channels(created_action)
+    finally:
+        target_rig.animation_data.action = None
+        # Un-solo
+        track.is_solo = False
+        if (scene.frame_current, scene.frame_subframe) != (prev_frame, prev_subframe):
+            scene.frame_set(prev_frame, subframe = prev_subframe)
+    return created_action, is_root_motion_skipped
+
+def bake_nla_from_source_to_target_rig(context, source_rig, target_rig, tracks_to_bake = None):
+    """bake all unmuted nla tracks (or only tracks_to_bake) from source rig to target rig"""
+    deselect_all(context)
+    # get tracks to bake
+    if tracks_to_bake is None:
+        tracks_to_bake = get_tracks_to_bake(source_rig)
+    # save solo state to restore it later
+    prev_solo = None
+    if source_rig.animation_data and any((solo_track := track).is_solo for track in source_rig.animation_data.nla_tracks):
+        prev_solo = solo_track
+    # select target object
+    target_rig.select_set(True)
+    context.view_layer.objects.active = target_rig
+    # create target's animation_data if it does not exist
+    if not target_rig.animation_data:
+        target_rig.animation_data_create()
+    # bake tracks. Identical inputs (of any previewing rig) are only baked once and share the baked action
+    rigify_properties = source_rig.sr_rigify_properties
+    # always restore solo track state, even if baking failed
+    try:
+        rig_digest = get_rig_digest(source_rig)
+        baked_actions = get_baked_actions_by_bake_key()
+        for track in tracks_to_bake:
+            name = get_track_name(track, rigify_properties.animation_naming)
+            bake_key = get_bake_key(source_rig, track, rig_digest)
+            if bake_key not in baked_actions:
+                baked_actions[bake_key] = bake_track(context, source_rig, target_rig, track, name)
+            created_action, is_root_motion_skipped = baked_actions[bake_key]
+            # Push down (new track then new strip from action)
+            new_track = target_rig.animation_data.nla_tracks.new()
+            new_strip = new_track.strips.new(created_action.name, int(created_action.frame_range[0]), created_action)
+            # use track.name since action.name may have suffixes
+            new_track.name = name
+            new_strip.name = name
+            # remember what was baked to only rebake stale tracks when updating
+            baked_track = source_rig.sr_rigify_properties.baked_tracks.add()
+            baked_track.name = new_track.name
+            baked_track.track_name = track.name
+            baked_track.bake_key = bake_key
+            baked_track.signature = get_track_signature(source_rig, track, bake_key)
+            baked_track.strips_signature = properties.get_strips_signature(track)
+            baked_track.action = created_action
+            baked_track.is_root_motion_skipped = is_root_motion_skipped
+    finally:
+        target_rig.animation_data.action = None
+        # restore solo track state
+        if prev_solo:
+            prev_solo.is_solo = True
+
+def get_bone_mapping(gameready_rig):
+    """returns (generated bone name, rigify bone name) of all bones of gameready_rig constrained to rigify"""
+    constraint_name = properties.AddonPreferences.prefix + 'COPY_LOCATION'
+    mapping = []
+    for pose_bone in gameready_rig.pose.bones:
+        constraint = pose_bone.constraints.get(constraint_name)
+        if constraint and constraint.subtarget:
+            mapping.append((pose_bone.name, constraint.subtarget))
+    return mapping
+
+def read_pose_matrices(rig_object):
+    """returns the (bones, 4, 4) armature space matrices of all pose bones of rig_object"""
+    pose_bones = rig_object.pose.bones
+    matrices = np.empty(len(pose_bones) * 16, dtype = np.float32)
+    pose_bones.foreach_get("matrix", matrices)
+    # matrices are flattened column-major
+    return matrices.reshape(-1, 4, 4).transpose(0, 2, 1)
+
+def get_pose_errors(source_matrices, target_matrices):
+    """returns per bone position error and rotation error (degrees) between two (bones, 4, 4) arrays"""
+    position_errors = np.linalg.norm(source_matrices[:, :3, 3] - target_matrices[:, :3, 3], axis = -1)
+    source_rotations = source_matrices[:, :3, :3] / np.linalg.norm(source_matrices[:, :3, :3], axis = 1, keepdims = True)
+    target_rotations = target_matrices[:, :3, :3] / np.linalg.norm(target_matrices[:, :3, :3], axis = 1, keepdims = True)
+    # trace(Rs^T Rt) = 1 + 2cos(angle)
+    cosines = (np.einsum('bij,bij->b', source_rotations, target_rotations) - 1.) / 2.
+    return position_errors, np.degrees(np.arccos(np.clip(cosines, -1., 1.)))
+
+def validate_baked_tracks(context, rigify_rig, gameready_rig, sample_count = 5, excluded_bonenames = ()):
+    """
+    compare the pose of gameready_rig playing each baked track with the pose of rigify_rig playing its source track, on sample_count frames
+    Returns [(track name, max position error, its bone name, max rotation error, its bone name)]
+    """
+    scene = context.scene
+    mapping = [(target, source) for target, source in get_bone_mapping(gameready_rig) if target not in excluded_bonenames]
+    target_indices = np.array([gameready_rig.pose.bones.find(target) for target, _ in mapping], dtype = np.int64)
+    source_indices = np.array([rigify_rig.pose.bones.find(source) for _, source in mapping], dtype = np.int64)
+    bonenames = [target for target, _ in mapping]
+    # save states to restore them after
+    prev_frame, prev_subframe = scene.frame_current, scene.frame_subframe
+    prev_hide_viewport, prev_hide = rigify_rig.hide_viewport, rigify_rig.hide_get()
+    prev_source_solo = next((track for track in rigify_rig.animation_data.nla_tracks if track.is_solo), None) if rigify_rig.animation_data else None
+    prev_target_solo = next((track for track in gameready_rig.animation_data.nla_tracks if track.is_solo), None) if gameready_rig.animation_data else None
+    results = []
+    # always restore states, even if validation failed
+    try:
+        # rigify must be visible to be evaluated
+        rigify_rig.hide_viewport = False
+        rigify_rig.hide_set(False)
+        for baked_track in rigify_rig.sr_rigify_properties.baked_tracks:
+            source_track = rigify_rig.animation_data.nla_tracks.get(baked_track.track_name) if rigify_rig.animation_data else None
+            target_track = gameready_rig.animation_data.nla_tracks.get(baked_track.name) if gameready_rig.animation_data else None
+            if source_track is None or target_track is None:
+                continue
+            source_track.is_solo = True
+            target_track.is_solo = True
+            frame_start, frame_end = get_nla_track_frame_range(source_track)
+            position_errors = np.zeros(len(mapping))
+            rotation_errors = np.zeros(len(mapping))
+            for frame in np.unique(np.linspace(frame_start, frame_end, sample_count).round().astype(int)):
+                scene.frame_set(int(frame))
+                frame_position_errors, frame_rotation_errors = get_pose_errors(read_pose_matrices(rigify_rig)[source_indices], read_pose_matrices(gameready_rig)[target_indices])
+                np.maximum(position_errors, frame_position_errors, out = position_errors)
+                np.maximum(rotation_errors, frame_rotation_errors, out = rotation_errors)
+            source_track.is_solo = False
+            target_track.is_solo = False
+            if mapping:
+                worst_position, worst_rotation = int(np.argmax(position_errors)), int(np.argmax(rotation_errors))
+                results.append((baked_track.name, float(position_errors[worst_position]), bonenames[worst_position], float(rotation_errors[worst_rotation]), bonenames[worst_rotation]))
+    finally:
+        # restore states
+        for rig_object, prev_solo in ((rigify_rig, prev_source_solo), (gameready_rig, prev_target_solo)):
+            if rig_object.animation_data:
+                for track in rig_object.animation_data.nla_tracks:
+                    if track.is_solo:
+                        track.is_solo = False
+            if prev_solo:
+                prev_solo.is_solo = True
+        rigify_rig.hide_viewport = prev_hide_viewport
+        rigify_rig.hide_set(prev_hide)
+        scene.frame_set(prev_frame, subframe = prev_subframe)
+    return results
+
+def rename_matching(list, name):
+    """rename any matching element in list and returns it. Simply add a prefix"""
+    if any((matching := elem).name == name for elem in list):
+        matching.name = properties.AddonPreferences.prefix + matching.name
+        return matching
+    return None
+
+def scale_location_fcurves(action, scale_factor):
+    """scale keyframes and handles of all location F-curves of action by scale_factor"""
+    for fcurve in action.fcurves:
+        if not fcurve.data_path.endswith("location"):
+            continue
+        keyframe_points = fcurve.keyframe_points
+        keyframes = np.empty(len(keyframe_points) * 2, dtype = np.float32)
+        for attribute in ("co", "handle_left", "handle_right"):
+            keyframe_points.foreach_get(attribute, keyframes)
+            # [1::2] is y-axis
+            keyframes[1::2] *= scale_factor
+            keyframe_points.foreach_set(attribute, keyframes)
+        fcurve.update()
+
+def apply_rig_transform(rig_object, meshes):
+    """apply the transform of rig_object to its armature and meshes data directly, without bpy.ops or selection"""
+    matrix = rig_object.matrix_basis.copy()
+    # bones head/tail/roll in bulk
+    rig_object.data.transform(matrix)
+    for mesh in meshes:
+        # vertices, shape keys and custom normals in bulk
+        mesh.data.transform(matrix @ mesh.matrix_parent_inverse @ mesh.matrix_basis, shape_keys = True)
+        mesh.matrix_parent_inverse = Matrix()
+        mesh.matrix_basis = Matrix()
+    rig_object.matrix_basis = Matrix()
+
+def scale_for_export(context, rig_object, meshes, scale_target):
+    """Scale to scale_target scene, rig, nla anims, and all meshes parented"""
+    scene = context.scene
+    scene_unit_scale = scene.unit_settings.scale_length
+    scale_factor = scene_unit_scale / scale_target
+    # disable auto-keyframing
+    prev_autokey = scene.tool_settings.use_keyframe_insert_auto
+    scene.tool_settings.use_keyframe_insert_auto = False
+    ### ASSUMES SCENE DEFAULT UNIT IS 1.0 ### ????????
+    # scale down scene to scale_target
+    scene.unit_settings.scale_length = scale_target
+    # scale rig by scale_factor
+    rig_object.scale[0] *= scale_factor
+    rig_object.scale[1] *= scale_factor
+    rig_object.scale[2] *= scale_factor
+    # scale rig position by scale_factor
+    rig_object.location *= scale_factor
+    # apply scales on armature & meshes
+    apply_rig_transform(rig_object, meshes)
+    # scale nla_tracks by scale_factor
+    if rig_object.animation_data:
+        # assume no active action in animation_data
+        # nla_tracks are already all made up of only 1 strip
+        # tracks may share the same baked action, only scale it once
+        for action in {nla_track.strips[0].action for nla_track in rig_object.animation_data.nla_tracks}:
+            scale_location_fcurves(action, scale_factor)
+    # restore auto-keyframing
+    scene.tool_settings.use_keyframe_insert_auto = prev_autokey
+
+def get_manifest_file_path(file_path):
+    """returns the path of the manifest written next to the fbx at file_path"""
+    return os.path.splitext(file_path)[0] + ".json"
+
+def get_file_digest(file_path):
+    """returns the sha256 of the file at file_path"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_export_manifest(context, gameready_rig, export_mode, sample_step = 1.0):
+    """returns skeleton and per-clip metadata of what is exported from gameready_rig"""
+    scene = context.scene
+    manifest = {
+        "armature": gameready_rig.data.name,
+        "export_mode": export_mode,
+        "bones": [{"name": bone.name, "parent": bone.parent.name if bone.parent else ""} for bone in gameready_rig.data.bones],
+        "clips": []
+    }
+    if export_mode == 'ARMATURE' or not gameready_rig.animation_data:
+        return manifest
+    sample_rate = scene.render.fps / scene.render.fps_base / sample_step
+    for nla_track in gameready_rig.animation_data.nla_tracks:
+        if not nla_track.strips or not nla_track.strips[0].action:
+            continue
+        action = nla_track.strips[0].action
+        frame_start, frame_end = get_nla_track_frame_range(nla_track)
+        manifest["clips"].append({
+            "name": nla_track.name,
+            "frame_start": frame_start,
+            "frame_end": frame_end,
+            "sample_rate": sample_rate,
+            "keyframe_count": max((len(fcurve.keyframe_points) for fcurve in action.fcurves), default = 0),
+            "hash": get_action_digest(action).hex()
+        })
+    return manifest
+
+def write_export_manifest(file_path, manifest, export_time):
+    """write manifest next to the exported fbx at file_path, with output size, hash and timing"""
+    manifest["file"] = os.path.basename(file_path)
+    manifest["size"] = os.path.getsize(file_path)
+    manifest["hash"] = get_file_digest(file_path)
+    manifest["export_time"] = export_time
+    with open(get_manifest_file_path(file_path), "w") as file:
+        json.dump(manifest, file, indent = 4)
@@ -25,8 +25,69 @@ def is_parented_mesh(self, object):
             return is_rigify(None, object.parent) or is_generated_rig(None, object.parent)
     return False
 
+def get_strips_signature(track, names = True):
+    """returns a cheap signature of the strips of track, without their keyframes. Strip names can be left out as they do not change baking"""
+    return repr([(strip.name if names else "", strip.action.name if strip.action else "", strip.frame_start, strip.frame_end, strip.action_frame_start, strip.action_frame_end,
+        strip.scale, strip.repeat, strip.blend_type, strip.extrapolation, strip.influence, strip.use_reverse, strip.mute) for strip in track.strips])
+
+def get_settings_signature(rigify_properties):
+    """returns a cheap signature of the settings the preview is built and baked with"""
+    return repr((rigify_properties.export_mode, rigify_properties.disconnect_all_bones, rigify_properties.recenter, rigify_properties.animation_naming,
+        rigify_properties.compact_channels, rigify_properties.root_motion, rigify_properties.root_motion_bone, rigify_properties.root_motion_hips,
+        rigify_properties.have_additional_bones, [bone.name for bone in rigify_properties.additional_bones]))
+
+def mark_stale_tracks(rigify_rig, updated_action_names, is_rigify_updated, is_armature_updated):
+    """flag baked tracks of rigify_rig whose source changed since they were baked"""
+    nla_tracks = rigify_rig.animation_data.nla_tracks if rigify_rig.animation_data else {}
+    for baked_track in rigify_rig.sr_rigify_properties.baked_tracks:
+        if baked_track.is_stale:
+            continue
+        track = nla_tracks.get(baked_track.track_name)
+        is_stale = track is None or is_armature_updated
+        if not is_stale and updated_action_names:
+            is_stale = any(strip.action and strip.action.name in updated_action_names for strip in track.strips)
+        if not is_stale and is_rigify_updated:
+            is_stale = track.mute or get_strips_signature(track) != baked_track.strips_signature
+        if is_stale:
+            baked_track.is_stale = True
+
+def update_stale_tracks(depsgraph):
+    """check depsgraph updates against the sources of previewing rigs"""
+    updated_action_names = set()
+    updated_ids = set()
+    for update in depsgraph.updates:
+        updated_id = update.id.original
+        if isinstance(updated_id, bpy.types.Action):
+            updated_action_names.add(updated_id.name)
+        elif isinstance(updated_id, bpy.types.Object):
+            updated_ids.add(updated_id.name_full)
+        elif isinstance(updated_id, bpy.types.Armature) and (update.is_updated_geometry or update.is_updated_transform):
+            # ignore other armature updates, e.g. selecting bones
+            updated_ids.add(updated_id.name_full)
+    if not updated_action_names and not updated_ids:
+        return
+    # only previewing rigs (in the addon collection) have baked tracks
+    collection = bpy.data.collections.get(AddonPreferences.collection_name)
+    if collection is None:
+        return
+    for generated_rig in collection.objects:
+        rigify_rig = generated_rig.sr_origin if is_generated_rig(None, generated_rig) else None
+        if rigify_rig is None or not rigify_rig.sr_rigify_properties.baked_tracks:
+            continue
+        is_rigify_updated = rigify_rig.name_full in updated_ids
+        # armature data geometry is only updated by bone edits, not by posing
+        is_armature_updated = rigify_rig.data.name_full in updated_ids
+        if updated_action_names or is_rigify_updated or is_armature_updated:
+            mark_stale_tracks(rigify_rig, updated_action_names, is_rigify_updated, is_armature_updated)
+
 @bpy.app.handlers.persistent
-def depsgraph_update_handler(scene):
+def depsgraph_update_handler(scene, depsgraph = None):
+    if depsgraph is not None:
+        update_stale_tracks(depsgraph)
+    update_current_rigify(scene)
+
+def update_current_rigify(scene):
+    """set current rigify of scene from the active object"""
     if bpy.context.object is None:
         scene.sr_current_rigify = None
         return
@@ -50,6 +111,37 @@ def depsgraph_update_handler(scene):
     # other
     scene.sr_current_rigify = None
     return
+
+def attach_depsgraph_handler():
+    if depsgraph_update_handler not in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.append(depsgraph_update_handler)
+
+def detach_depsgraph_handler():
+    if depsgraph_update_handler in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(depsgraph_update_handler)
+
+# owner of the message bus subscription to active object changes
+msgbus_owner = object()
+
+def active_object_changed():
+    """cheap replacement of the depsgraph handler while the file has no rigify rig: attach it once a rigify rig gets involved"""
+    scene = bpy.context.scene
+    update_current_rigify(scene)
+    if scene.sr_current_rigify is not None:
+        attach_depsgraph_handler()
+
+def subscribe_active_object():
+    bpy.msgbus.clear_by_owner(msgbus_owner)
+    bpy.msgbus.subscribe_rna(key = (bpy.types.LayerObjects, "active"), owner = msgbus_owner, args = (), notify = active_object_changed, options = {'PERSISTENT'})
+
+@bpy.app.handlers.persistent
+def load_post_handler(*args):
+    """only keep the depsgraph handler while the loaded file contains rigify rigs"""
+    subscribe_active_object()
+    if any(is_rigify(None, object) for object in bpy.data.objects):
+        attach_depsgraph_handler()
+    else:
+        detach_depsgraph_handler()
     
 
 class AddonPreferences(bpy.types.AddonPreferences):
@@ -87,6 +179,29 @@ class SanitizeRigifyBoneProperty(bpy.types.PropertyGroup):
     """
     name : bpy.props.StringProperty(name="Bone name", override = {'LIBRARY_OVERRIDABLE'})
 
+class SanitizeRigifyTrackProperty(bpy.types.PropertyGroup):
+    """
+    Baked track in list of baked tracks
+    """
+    name : bpy.props.StringProperty(name="Baked track name", override = {'LIBRARY_OVERRIDABLE'})
+    track_name : bpy.props.StringProperty(name="Source track name", override = {'LIBRARY_OVERRIDABLE'})
+    signature : bpy.props.StringProperty(name="Signature", description = "Hash of what the track was baked from", override = {'LIBRARY_OVERRIDABLE'})
+    action : bpy.props.PointerProperty(type = bpy.types.Action, name = "Baked action", override = {'LIBRARY_OVERRIDABLE'})
+    bake_key : bpy.props.StringProperty(name="Bake key", description = "Hash of the bake inputs, tracks with the same key share their baked action", override = {'LIBRARY_OVERRIDABLE'})
+    strips_signature : bpy.props.StringProperty(name="Strips signature", description = "Strip settings the track was baked from", override = {'LIBRARY_OVERRIDABLE'})
+    is_stale : bpy.props.BoolProperty(name = "Stale", default = False, description = "Source changed since the track was baked", override = {'LIBRARY_OVERRIDABLE'})
+    is_root_motion_skipped : bpy.props.BoolProperty(name = "Root motion skipped", default = False, description = "Root motion was enabled but could not be extracted from the track", override = {'LIBRARY_OVERRIDABLE'})
+
+class SanitizeRigifyDatablockProperty(bpy.types.PropertyGroup):
+    """
+    Datablock created by the addon, in list of generated datablocks
+    """
+    # one pointer per generated type, so that renaming or reusing names never points to user data
+    object : bpy.props.PointerProperty(type = bpy.types.Object, name = "Object", override = {'LIBRARY_OVERRIDABLE'})
+    mesh : bpy.props.PointerProperty(type = bpy.types.Mesh, name = "Mesh", override = {'LIBRARY_OVERRIDABLE'})
+    armature : bpy.props.PointerProperty(type = bpy.types.Armature, name = "Armature", override = {'LIBRARY_OVERRIDABLE'})
+    action : bpy.props.PointerProperty(type = bpy.types.Action, name = "Action", override = {'LIBRARY_OVERRIDABLE'})
+
 class SanitizeRigifyProperties(bpy.types.PropertyGroup):
     """
     Collection property holding properties of a unit.
@@ -135,17 +250,34 @@ class SanitizeRigifyProperties(bpy.types.PropertyGroup):
     path : bpy.props.StringProperty(name = "Path", default = "//", subtype = 'DIR_PATH', set = set_path, get = get_path, override = {'LIBRARY_OVERRIDABLE'}, description = "Export path for this rig. Renaming the rig will reset")
     # Used to reset path when duplicating rigs. If this is not the same as the object's name then reset path
     path_owner : bpy.props.StringProperty(name = "Path owner", default = "", options = {'HIDDEN'}, override = {'LIBRARY_OVERRIDABLE'})
+    compact_channels : bpy.props.BoolProperty(name = "Compact channels", default = True, override = {'LIBRARY_OVERRIDABLE'}, description = "After baking, keep quaternions continuous and reduce channels that do not change to two keyframes")
+    root_motion : bpy.props.BoolProperty(name = "Root motion", default = False, override = {'LIBRARY_OVERRIDABLE'}, description = "After baking, move the planar translation and yaw of the hips to the root bone")
+    root_motion_bone : bpy.props.StringProperty(name = "Root bone", default = "root", override = {'LIBRARY_OVERRIDABLE'}, description = "Bone receiving root motion (name in the generated rig)")
+    root_motion_hips : bpy.props.StringProperty(name = "Hips bone", default = "spine", override = {'LIBRARY_OVERRIDABLE'}, description = "Bone root motion is extracted from (name in the generated rig). Must be a child of the root bone")
+    streaming_bake : bpy.props.BoolProperty(name = "Streaming bake", default = False, override = {'LIBRARY_OVERRIDABLE'}, description = "Bake long tracks in windows of frames to bound memory usage")
+    bake_window_size : bpy.props.IntProperty(name = "Window size", default = 1000, min = 1, override = {'LIBRARY_OVERRIDABLE'}, description = "Number of frames baked at once when streaming")
+    # Used to only update what changed when previewing again
+    hierarchy_signature : bpy.props.StringProperty(name = "Hierarchy signature", default = "", options = {'HIDDEN'}, override = {'LIBRARY_OVERRIDABLE'})
+    settings_signature : bpy.props.StringProperty(name = "Settings signature", default = "", options = {'HIDDEN'}, override = {'LIBRARY_OVERRIDABLE'})
+    generated_datablocks : bpy.props.CollectionProperty(type = SanitizeRigifyDatablockProperty, name = "Generated datablocks", override = {'LIBRARY_OVERRIDABLE'}, description = "Datablocks created by the addon for this rig, freed on Unpreview")
+    baked_tracks : bpy.props.CollectionProperty(type = SanitizeRigifyTrackProperty, name = "Baked tracks", override = {'LIBRARY_OVERRIDABLE'}, description = "Tracks baked on the generated rig")
 
 def register():
     bpy.types.Object.sr_rigify_properties = bpy.props.PointerProperty(type = SanitizeRigifyProperties, override = {'LIBRARY_OVERRIDABLE'})
     bpy.types.Object.sr_origin = bpy.props.PointerProperty(type = bpy.types.Object, poll = is_rigify, override = {'LIBRARY_OVERRIDABLE'}, description = "Origin rigify")
     bpy.types.Scene.sr_current_rigify = bpy.props.PointerProperty(type = bpy.types.Object, poll = is_rigify, override = {'LIBRARY_OVERRIDABLE'}, description = "Current rigify")
-    # handler to update current_rigify
-    bpy.app.handlers.depsgraph_update_post.append(depsgraph_update_handler)
+    # handlers to update current_rigify. The depsgraph handler is only attached when the file contains rigify rigs
+    bpy.app.handlers.load_post.append(load_post_handler)
+    # bpy.data is not available while registering, check the current file right after
+    bpy.app.timers.register(load_post_handler, first_interval = 0.)
 
 def unregister():
     del bpy.types.Object.sr_rigify_properties
     del bpy.types.Object.sr_origin
     del bpy.types.Scene.sr_current_rigify
-    # handler to update current_rigify
-    bpy.app.handlers.depsgraph_update_post.remove(depsgraph_update_handler)
+    # handlers to update current_rigify
+    if bpy.app.timers.is_registered(load_post_handler):
+        bpy.app.timers.unregister(load_post_handler)
+    bpy.app.handlers.load_post.remove(load_post_handler)
+    bpy.msgbus.clear_by_owner(msgbus_owner)
+    detach_depsgraph_handler()
@@ -0,0 +1,102 @@
+"""
+Memory test: memory and datablock counts must stay flat over Preview/Unpreview cycles.
+
+Run from the addon folder, optionally with a file containing a rigify rig (one is generated otherwise):
+    blender --background [file.blend] --python tests/memory_cycles.py -- [--cycles 20] [--warmup 2] [--tolerance 32]
+Exits with code 1 if memory or datablocks grow.
+"""
+import bpy
+import addon_utils
+import argparse
+import gc
+import os
+import sys
+
+data_collections = ("objects", "meshes", "armatures", "actions", "collections", "materials")
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description = "Preview/Unpreview memory test")
+    parser.add_argument("--cycles", type = int, default = 20, help = "number of measured Preview/Unpreview cycles")
+    parser.add_argument("--warmup", type = int, default = 2, help = "number of cycles run before measuring")
+    parser.add_argument("--tolerance", type = float, default = 32., help = "allowed memory growth (MB) over the measured cycles")
+    return parser.parse_args(argv)
+
+def enable_addon():
+    """enable the addon from this folder, returns its module name"""
+    addon_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.path.dirname(addon_path))
+    module_name = os.path.basename(addon_path)
+    if addon_utils.enable(module_name, default_set = True) is None:
+        sys.exit("Could not enable " + module_name)
+    return module_name
+
+def get_rss():
+    """returns the resident memory (MB), or the peak resident memory where it is not available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        # not Linux (resource is not available on Windows)
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 2 ** 10
+
+def get_data_counts():
+    return {data_collection: len(getattr(bpy.data, data_collection)) for data_collection in data_collections}
+
+def create_rigify_rig(context, is_rigify):
+    """generate a rigify rig with a mesh and an animated NLA track"""
+    addon_utils.enable("rigify", default_set = True)
+    bpy.ops.object.armature_human_metarig_add()
+    bpy.ops.pose.rigify_generate()
+    bpy.ops.object.mode_set(mode = 'OBJECT')
+    rigify_rig = next(object for object in bpy.data.objects if is_rigify(None, object))
+    bpy.ops.mesh.primitive_cube_add(size = 0.5, location = (0., 0., 1.))
+    mesh = context.view_layer.objects.active
+    mesh.parent = rigify_rig
+    mesh.modifiers.new("Armature", 'ARMATURE').object = rigify_rig
+    # animate the torso over 48 frames
+    action = bpy.data.actions.new("Walk")
+    rigify_rig.animation_data_create()
+    rigify_rig.animation_data.action = action
+    torso = rigify_rig.pose.bones["torso"]
+    for frame in range(1, 49, 8):
+        torso.location = (0., frame * 0.05, 0.)
+        torso.keyframe_insert("location", frame = frame)
+    rigify_rig.animation_data.action = None
+    track = rigify_rig.animation_data.nla_tracks.new()
+    track.name = "Walk"
+    track.strips.new("Walk", 1, action)
+    return rigify_rig
+
+def main():
+    args = parse_args()
+    module_name = enable_addon()
+    properties = sys.modules[module_name + ".properties"]
+    context = bpy.context
+    rigify_rig = next((object for object in bpy.data.objects if properties.is_rigify(None, object)), None) or create_rigify_rig(context, properties.is_rigify)
+    context.scene.sr_current_rigify = rigify_rig
+
+    def cycle():
+        context.view_layer.objects.active = rigify_rig
+        assert 'FINISHED' in bpy.ops.sanitize_rigify.preview(), "Preview failed"
+        assert 'FINISHED' in bpy.ops.sanitize_rigify.unpreview(), "Unpreview failed"
+        gc.collect()
+
+    for _ in range(args.warmup):
+        cycle()
+    data_counts, rss = get_data_counts(), get_rss()
+    for index in range(args.cycles):
+        cycle()
+        if get_data_counts() != data_counts:
+            print("FAIL: datablocks grew after cycle", index + 1, get_data_counts(), "instead of", data_counts)
+            sys.exit(1)
+    growth = get_rss() - rss
+    print("Memory after", args.cycles, "cycles: %.1f MB -> %.1f MB (%+.1f MB)" % (rss, rss + growth, growth))
+    if growth > args.tolerance:
+        print("FAIL: memory grew by more than", args.tolerance, "MB")
+        sys.exit(1)
+    print("OK")
+
+main()
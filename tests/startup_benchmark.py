@@ -0,0 +1,58 @@
+"""
+Startup benchmark: time to import the addon, register() and unregister() it, and the load_post handler.
+
+Run from the addon folder, on an empty file (or on a file of yours to time its load_post handler):
+    blender --background --factory-startup [file.blend] --python tests/startup_benchmark.py -- [--runs 20]
+Exits with code 1 if registering imports the pipeline module.
+"""
+import bpy
+import argparse
+import importlib
+import os
+import statistics
+import sys
+import time
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(description = "Addon import and registration benchmark")
+    parser.add_argument("--runs", type = int, default = 20, help = "number of measured import/register/unregister runs")
+    return parser.parse_args(argv)
+
+def forget_addon(module_name):
+    """remove the addon modules so that the next import is a cold one"""
+    for name in [name for name in sys.modules if name == module_name or name.startswith(module_name + ".")]:
+        del sys.modules[name]
+
+def timed(function, *args):
+    """returns the result of function and its duration (ms)"""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000.
+
+def main():
+    args = parse_args()
+    addon_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.path.dirname(addon_path))
+    module_name = os.path.basename(addon_path)
+    timings = {"import": [], "register": [], "load_post": [], "unregister": []}
+    for _ in range(args.runs):
+        forget_addon(module_name)
+        addon, duration = timed(importlib.import_module, module_name)
+        timings["import"].append(duration)
+        _, duration = timed(addon.register)
+        timings["register"].append(duration)
+        if module_name + ".pipeline" in sys.modules:
+            print("FAIL: registering imported " + module_name + ".pipeline")
+            sys.exit(1)
+        _, duration = timed(addon.properties.load_post_handler)
+        timings["load_post"].append(duration)
+        _, duration = timed(addon.unregister)
+        timings["unregister"].append(duration)
+    forget_addon(module_name)
+    print("Sanitize Rigify startup (" + str(args.runs) + " runs, " + str(len(bpy.data.objects)) + " objects in file)")
+    for name, durations in timings.items():
+        print("  %-10s median %7.3f ms  min %7.3f ms  max %7.3f ms" % (name, statistics.median(durations), min(durations), max(durations)))
+    print("OK")
+
+main()
@@ -30,18 +30,29 @@ class SANITIZERIGIFY_PT_MainPanel(bpy.types.Panel):
         if current_rigify is not None:
             # mode
             row = layout.row(heading = "Export mode")
-            if operators.is_previewing(context, current_rigify):
-                row.enabled = False
             row.prop(current_rigify.sr_rigify_properties, "export_mode", text = "")
             # preview
             row = layout.row()
             if operators.can_preview(context, current_rigify):
                 row.operator(operators.SANITIZERIGIFY_OT_Preview.bl_idname, text = "Preview", emboss = True)
             else:
+                row.operator(operators.SANITIZERIGIFY_OT_Preview.bl_idname, text = "", icon = 'FILE_REFRESH', emboss = True)
                 row.operator(operators.SANITIZERIGIFY_OT_Unpreview.bl_idname, text = "Unpreview", emboss = True, depress = True)
             # export
             op = row.operator(operators.SANITIZERIGIFY_OT_Export.bl_idname)
             op.filepath = operators.get_default_file_path(context, current_rigify)
+            if operators.is_previewing(context, current_rigify):
+                row.operator(operators.SANITIZERIGIFY_OT_Validate.bl_idname, text = "", icon = 'CHECKMARK')
+            # changed settings (applied by Preview or Export)
+            if operators.is_previewing(context, current_rigify) and operators.has_outdated_settings(current_rigify):
+                layout.label(text = "Settings changed, update the preview", icon = 'ERROR')
+            # stale tracks (rebaked by Preview or Export)
+            if operators.has_stale_tracks(current_rigify):
+                col = layout.column(align = True)
+                col.label(text = "Out of date animations", icon = 'ERROR')
+                for baked_track in current_rigify.sr_rigify_properties.baked_tracks:
+                    if baked_track.is_stale:
+                        col.label(text = baked_track.name, translate = False, icon = 'NLA')
         return
 
 class SANITIZERIGIFY_PT_AdvancedPanel(bpy.types.Panel):
@@ -62,15 +73,31 @@ class SANITIZERIGIFY_PT_AdvancedPanel(bpy.types.Panel):
             row = layout.row(heading = "Armature name", align = True)
             row.prop(current_rigify.sr_rigify_properties, "armature_name", text = "")
             row.operator(operators.SANITIZERIGIFY_OT_ResetArmatureName.bl_idname, text = "", icon = 'RECOVER_LAST')
-            # options
+            # options (picked up by Preview when previewing)
             col = layout.column()
-            if operators.is_previewing(context, current_rigify):
-                col.enabled = False
             row = col.row()
             row.prop(current_rigify.sr_rigify_properties, "disconnect_all_bones", toggle = -1)
             row.prop(current_rigify.sr_rigify_properties, "recenter", toggle = -1)
             row = col.row(heading = "Animation naming")
             row.prop(current_rigify.sr_rigify_properties, "animation_naming", text = "")
+            row = col.row()
+            row.prop(current_rigify.sr_rigify_properties, "compact_channels", toggle = -1)
+            row = col.row(heading = "Root motion")
+            row.prop(current_rigify.sr_rigify_properties, "root_motion", text = "")
+            sub = row.row(align = True)
+            sub.enabled = current_rigify.sr_rigify_properties.root_motion
+            sub.prop(current_rigify.sr_rigify_properties, "root_motion_bone", text = "")
+            sub.prop(current_rigify.sr_rigify_properties, "root_motion_hips", text = "")
+            row = col.row(heading = "Streaming bake")
+            row.prop(current_rigify.sr_rigify_properties, "streaming_bake", text = "")
+            sub = row.row()
+            sub.enabled = current_rigify.sr_rigify_properties.streaming_bake
+            sub.prop(current_rigify.sr_rigify_properties, "bake_window_size", text = "Window")
+        # leftover generated data
+        row = layout.row(align = True)
+        row.operator(operators.SANITIZERIGIFY_OT_CheckGeneratedData.bl_idname, icon = 'VIEWZOOM')
+        op = row.operator(operators.SANITIZERIGIFY_OT_CheckGeneratedData.bl_idname, text = "", icon = 'TRASH')
+        op.remove = True
         return
 
 class SANITIZERIGIFY_PT_AdditionalBonesPanel(bpy.types.Panel):
@@ -88,13 +115,11 @@ class SANITIZERIGIFY_PT_AdditionalBonesPanel(bpy.types.Panel):
     def draw_header(self, context):
         layout = self.layout
         current_rigify = context.scene.sr_current_rigify
-        if operators.is_previewing(context, current_rigify):
-            layout.enabled = False
         layout.prop(current_rigify.sr_rigify_properties, "have_additional_bones", text="")
     def draw(self, context):
         layout = self.layout
         current_rigify = context.scene.sr_current_rigify
-        if operators.is_previewing(context, current_rigify) or not current_rigify.sr_rigify_properties.have_additional_bones:
+        if not current_rigify.sr_rigify_properties.have_additional_bones:
             layout.enabled = False
         row = layout.row(align = False)
         col = row.column()
@@ -102,6 +127,8 @@ class SANITIZERIGIFY_PT_AdditionalBonesPanel(bpy.types.Panel):
         col = row.column()
         col.operator(operators.SANITIZERIGIFY_OT_AddAdditionalBone.bl_idname, text = "", icon = 'ADD')
         col = row.column()
+        col.operator(operators.SANITIZERIGIFY_OT_AddAdditionalBones.bl_idname, text = "", icon = 'FILTER')
+        col = row.column()
         col.operator(operators.SANITIZERIGIFY_OT_ClearAdditionalBones.bl_idname, text = "", icon = 'CANCEL')
         if current_rigify.sr_rigify_properties.additional_bones:
             layout.template_list(SANITIZERIGIFY_UL_UIList.bl_idname, "", current_rigify.sr_rigify_properties, "additional_bones", current_rigify.sr_rigify_properties, "additional_bones_index")